@@ -2,7 +2,6 @@ import streamlit as st
 import pandas as pd
 import os
 import warnings
-from pathlib import Path
 from dotenv import load_dotenv
 from pdf_parser import *
 
@@ -18,6 +17,12 @@ warnings.filterwarnings(
 # ---- Streamlit UI ----
 st.set_page_config(page_title="PDF Table Extractor", layout="wide")
 
+@st.cache_data(show_spinner=False)
+def cached_excel_bytes(df: pd.DataFrame) -> bytes:
+    # Keyed on the frame's content hash, so reruns (e.g. clicking the
+    # download button) reuse the workbook instead of regenerating it
+    return dataframe_to_excel_bytes(df)
+
 # Authentication - development
 # USERNAME = st.secrets['authentication']['username']
 # PASSWORD = st.secrets['authentication']['password']
@@ -57,44 +62,20 @@ else:
         uploaded_pdf = st.file_uploader("Choose a PDF", type=["pdf"])
         form_submit_button = st.form_submit_button("Submit", type="primary")
         if form_submit_button:
-            
-            # Parsing part
-            # Parse PDF with Camelot
-            number_of_camelot_tables = read_and_store_to_csv(uploaded_pdf, 'parsed_pdf.csv')
-            # If Camelot failed to parse page, count number of pages
-            number_of_pages = check_number_of_pages(uploaded_pdf)
-            # If number of pages greater than the number Camelot counted, apply Camelot stream logic, and append to raw csv
-            if number_of_pages > number_of_camelot_tables:
-                append_camelot_missing_to_csv(uploaded_pdf, number_of_pages, 'parsed_pdf.csv')
-
-            # Apply CSV modification afterwards
-            modify_csv('parsed_pdf.csv', 'parsed_pdf_modified.csv')
-
-            # Structure to dictionary
-            raw_text = Path('parsed_pdf_modified.csv').read_text(encoding="utf-8")
-            articles = parse_articles(raw_text)
-            # Clean of unmapped values
-            articles = [{k: v for k, v in d.items() if k != "_UNMAPPED_VALUES"} for d in articles]
-            # Create dataframe from the data
-            clean_df = load_and_flatten(articles)
-            # Process dataframe
-            clean_df = process_dataframe(clean_df)
-            st.session_state.df_to_show = clean_df
 
-            files_to_delete = ['parsed_pdf.csv', 'parsed_pdf_modified.csv']
-            for file in files_to_delete:
-                if os.path.exists(file):  # check if file exists
-                    os.remove(file)
-                    print(f"File {file} deleted successfully")
-                else:
-                    print(f"File {file} not found")
+            # Run the whole parsing pipeline in a worker process so Camelot's
+            # extraction does not block the Streamlit thread
+            with st.spinner("Parsing PDF..."):
+                future = EXECUTOR.submit(run_pipeline, uploaded_pdf.getvalue())
+                clean_df = future.result()
+            st.session_state.df_to_show = clean_df
 
 
     st.subheader("Extracted DataFrame")
     if st.session_state.df_to_show is not None:
         st.dataframe(st.session_state.df_to_show, width='stretch')
         # Excel download
-        excel_bytes = dataframe_to_excel_bytes(st.session_state.df_to_show)
+        excel_bytes = cached_excel_bytes(st.session_state.df_to_show)
         with st.columns(8)[7]:
             st.download_button(
                 label="📥 Download Excel",
@@ -1,10 +1,16 @@
 import pandas as pd
 import camelot
-import csv
+import os
 import re
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
 from pypdf import PdfReader
 from io import BytesIO
-from typing import List, Dict, Tuple
+from typing import Iterable, List, Dict, Tuple
+
+
+# Shared worker pool for PDF parsing. The module is imported once per server
+# process, so the pool persists across Streamlit reruns.
+EXECUTOR = ProcessPoolExecutor(max_workers=os.cpu_count())
 
 
 def check_number_of_pages(pdf_file: str) -> int:
@@ -12,32 +18,48 @@ def check_number_of_pages(pdf_file: str) -> int:
     Count number of pages of PDF file
     """
     reader = PdfReader(pdf_file)
-    num_pages = len(reader.pages)
-    return num_pages
-
-def read_and_store_to_csv(pdf_file_path: str, csv_file_path: str = 'combined_table.csv') -> None:
+    try:
+        # The page-tree root carries the count directly — O(1) vs. len(pages)
+        # materializing a PageObject per page
+        return int(reader.trailer["/Root"]["/Pages"]["/Count"])
+    except KeyError:
+        # Malformed catalog — fall back to walking the page tree
+        return len(reader.pages)
+
+def read_pdf_tables(pdf_file_path: str) -> Tuple[int, List[pd.DataFrame]]:
     """
-    Parse EVD PDF file, save it to raw CSV
+    Parse EVD PDF file with the lattice flavor, return the number of tables
+    and their DataFrames
     """
     tables = camelot.read_pdf(
-        pdf_file_path, 
-        pages='all', 
-        flavor='lattice', 
+        pdf_file_path,
+        pages='all',
+        flavor='lattice',
         process_background=True
     )
 
     # Extract the DataFrames
     dfs = [table.df for table in tables]
-    # Concatenate all DataFrames into one
-    combined_df = pd.concat(dfs, ignore_index=True)
-    # Optionally, save to CSV
-    combined_df.to_csv(csv_file_path, index=False)
-    return len(dfs)
+    return len(dfs), dfs
 
-def append_camelot_missing_to_csv(pdf_file: str, missing_page_number: int, raw_csv_file: str = 'combined_table.csv') -> None:
+def dataframes_to_text(dfs: List[pd.DataFrame]) -> str:
+    """
+    Flatten Camelot table DataFrames cell by cell in row order into the
+    newline-separated text that parse_articles consumes
+    """
+    parts = []
+    for df in dfs:
+        parts.append("\n".join(x for x in df.to_numpy().ravel().astype(str) if x))
+    return "\n".join(parts) + "\n"
+
+def read_camelot_missing(pdf_file: str, missing_page_number: int) -> pd.DataFrame:
+    """
+    Parse a page the lattice pass missed with the stream flavor, return it as
+    a single-column DataFrame ready to concat onto the combined table
+    """
     tables = camelot.read_pdf(
-        pdf_file, 
-        pages=f'{missing_page_number}', 
+        pdf_file,
+        pages=f'{missing_page_number}',
         flavor='stream',
     )
 
@@ -47,41 +69,39 @@ def append_camelot_missing_to_csv(pdf_file: str, missing_page_number: int, raw_c
     # Remove header row(s) like "Seite 4 von 4 ..." and reset index
     df = df[~df[0].str.contains("Seite", na=False)].reset_index(drop=True)
 
-    # Append lines to CSV file
-    with open(raw_csv_file, "a", encoding="utf-8", newline="") as f:
-        writer = csv.writer(f)
-        
-        for row in df.itertuples(index=False):
-            line = "\n".join([str(x) for x in row if x])
-            writer.writerow([line])    
+    # Join non-empty cells of each row into one block of lines
+    rows = df.astype(str).agg(lambda row: "\n".join(x for x in row if x), axis=1)
+    return rows.to_frame(name=0)
+
+# Lines needing special handling in modify_lines: the Dokument section
+# terminator and the Mengeneinheit prefix
+_MODIFY_PREFIXES = ('18 DOKUMENT – ZERTIFIKAT', "Mengeneinheit")
 
-def modify_csv(input_csv: str = 'combined_table.csv', output_csv: str = 'combined_table_modified.csv'):
+def modify_lines(lines: Iterable[str]) -> str:
     """
-    Reads a CSV file, modifies it by:
+    Modifies raw text lines in memory by:
       1. Prefixing lines that start with 'Mengeneinheit' with '17w '
       2. Removing everything starting from '18 DOKUMENT – ZERTIFIKAT' (inclusive)
 
-    :param input_csv: Path to the input CSV file
-    :param output_csv: Path to the output CSV file
+    :param lines: Iterable of lines (with trailing newlines preserved)
+    :return: The modified text as a single string
     """
-    with open(input_csv, "r", encoding="utf-8") as infile, open(output_csv, "w", encoding="utf-8") as outfile:
-        for line in infile:
+    out_lines = []
+    for line in lines:
 
-            # Remove all double quotes
-            line = line.replace('"', '')
-
-            # Strip only trailing newline for checking
-            stripped = line.lstrip()
+        # Strip only trailing newline for checking
+        stripped = line.lstrip()
 
+        # One startswith call covers both special prefixes
+        if stripped.startswith(_MODIFY_PREFIXES):
             # If we hit the Dokument section, stop writing completely
             if stripped.startswith('18 DOKUMENT – ZERTIFIKAT'):
                 break
-            
-            # If line starts with Mengeneinheit, prefix it
-            if stripped.startswith("Mengeneinheit"):
-                outfile.write("17w " + stripped)
-            else:
-                outfile.write(line)
+            # Line starts with Mengeneinheit, prefix it
+            out_lines.append("17w " + stripped)
+        else:
+            out_lines.append(line)
+    return "".join(out_lines)
 
 
 
@@ -89,23 +109,27 @@ def modify_csv(input_csv: str = 'combined_table.csv', output_csv: str = 'combine
 KEY_RE = re.compile(r'^(17(?:\.\d+)?[A-Za-z])(?:\s+(.*))?$', re.IGNORECASE)
 # Matches lines like: "17.1 PACKSTÜCKE" or "17 PACKSTUECKE" (with or without Ü)
 PACK_HEADER_RE = re.compile(r'^(17(?:\.\d+)?)\s+PACKST[ÜU]CKE\b', re.IGNORECASE)
-SEGMENT_HEADER_RE = re.compile(r'(?im)^\s*"?\s*17 POSITIONSDATEN\b')
+SEGMENT_HEADER_RE = re.compile(r'(?im)(^\s*"?\s*17 POSITIONSDATEN\b)')
+
+# Line token kinds used by parse_segment's single classification pass
+_TOK_KEY, _TOK_PACK, _TOK_SEG, _TOK_VALUE = range(4)
 
 
+# Deletes double quotes in one C-level pass
+_DEL_QUOTE = str.maketrans('', '', '"')
+
 def normalize_line(s: str) -> str:
-    return s.strip().strip('"').strip()
+    return s.translate(_DEL_QUOTE).strip()
 
 
 def split_into_segments(raw_text: str) -> List[str]:
     """Return list of text segments each starting with '17 POSITIONSDATEN'."""
-    starts = [m.start() for m in SEGMENT_HEADER_RE.finditer(raw_text)]
-    if not starts:
+    # The capturing group keeps each header in the split output, so one pass
+    # yields [preamble, header, body, header, body, ...]
+    parts = SEGMENT_HEADER_RE.split(raw_text)
+    if len(parts) < 3:
         return []
-    segments = []
-    for idx, start in enumerate(starts):
-        end = starts[idx + 1] if idx + 1 < len(starts) else len(raw_text)
-        segments.append(raw_text[start:end])
-    return segments
+    return [parts[i] + parts[i + 1] for i in range(1, len(parts) - 1, 2)]
 
 
 def parse_segment(segment: str) -> Dict:
@@ -116,45 +140,63 @@ def parse_segment(segment: str) -> Dict:
       "PACKSTÜCKE": { ... }  # optional
     }
     """
-    lines = [normalize_line(l) for l in segment.replace('\r', '\n').splitlines() if normalize_line(l) != '']
+    lines = [s for l in segment.replace('\r', '\n').splitlines() if (s := normalize_line(l))]
 
     # drop initial header line if present
     if lines and lines[0].upper().startswith("17 POSITIONSDATEN"):
         lines = lines[1:]
 
+    # Bind the compiled matchers as locals — avoids two attribute lookups per
+    # call in the classification loop below
+    _key_match = KEY_RE.match
+    _pack_match = PACK_HEADER_RE.match
+    _seg_match = SEGMENT_HEADER_RE.match
+
+    # Classify every line exactly once into (kind, line, key match); the walk
+    # below dispatches on the kind without re-running any regex
+    tokens: List[Tuple[int, str, 're.Match']] = []
+    for line in lines:
+        if _pack_match(line):
+            tokens.append((_TOK_PACK, line, None))
+        elif _seg_match(line):
+            tokens.append((_TOK_SEG, line, None))
+        elif (m := _key_match(line)):
+            tokens.append((_TOK_KEY, line, m))
+        else:
+            tokens.append((_TOK_VALUE, line, None))
+
     mapping: Dict[str, str] = {}
     pack_mapping: Dict[str, str] = {}
     pending_values: List[str] = []
     i = 0
-    while i < len(lines):
-        # If this line is a PACKSTÜCKE header, enable pack mode and skip it
-        if PACK_HEADER_RE.match(lines[i]):
+    n = len(tokens)
+    while i < n:
+        # Header lines are structural markers — skip them without appending
+        # to pending_values
+        if tokens[i][0] in (_TOK_PACK, _TOK_SEG):
             i += 1
-            # don't append this header to pending_values — it is a structural marker
             continue
 
         # collect consecutive keys starting at i (keys are like: 17e Label  or 17.1a Label)
         key_group: List[Tuple[str, str]] = []
-        while i < len(lines):
-            m = KEY_RE.match(lines[i])
-            if not m:
-                break
+        while i < n and tokens[i][0] == _TOK_KEY:
+            m = tokens[i][2]
             code = m.group(1)                # e.g. "17e" or "17.1a"
             label = (m.group(2).strip() if m.group(2) and m.group(2).strip() else code)  # fallback to code if label missing
             key_group.append((code, label))
             i += 1
 
-        # If no keys found, collect non-key lines as pending values (but skip PACK header lines)
+        # If no keys found, collect value lines as pending values
         if not key_group:
-            while i < len(lines) and not KEY_RE.match(lines[i]) and not SEGMENT_HEADER_RE.match(lines[i]) and not PACK_HEADER_RE.match(lines[i]):
-                pending_values.append(lines[i])
+            while i < n and tokens[i][0] == _TOK_VALUE:
+                pending_values.append(tokens[i][1])
                 i += 1
             continue
 
         # collect values up to the next key/header/pack header
         val_group: List[str] = []
-        while i < len(lines) and not KEY_RE.match(lines[i]) and not SEGMENT_HEADER_RE.match(lines[i]) and not PACK_HEADER_RE.match(lines[i]):
-            val_group.append(lines[i])
+        while i < n and tokens[i][0] == _TOK_VALUE:
+            val_group.append(tokens[i][1])
             i += 1
 
         # available values = leftover pending + newly read values
@@ -190,37 +232,42 @@ def parse_articles(raw_text: str) -> List[Dict]:
     return [parse_segment(seg) for seg in segments]
 
 
+# Known numeric text columns, pinned to the pandas string dtype so downstream
+# pd.to_numeric consumes string arrays instead of inferred object columns
+SCHEMA = {
+    "Menge": "string",
+    "Bruttomasse": "string",
+    "Nettomasse": "string",
+    "Alkoholgehalt": "string",
+    "Positionsnummer": "string",
+    "Anzahl der Packstücke": "string",
+}
+
 def load_and_flatten(records: List[Dict]) -> pd.DataFrame:
     """
     Load a list of nested dicts and flatten it into a pandas DataFrame.
-    Nested keys are combined with '_' to make unique column names.
+    Section dicts are merged per record — pack keys and positional keys are
+    disjoint, so column names stay unique.
     """
-    flat_records = []
-
-    for record in records:
-        flat_record = {}
-
-        for section_dict in record.values():
-            for key, value in section_dict.items():
-                flat_record[key] = value
-        flat_records.append(flat_record)
+    df = pd.json_normalize(
+        [{k: v for section_dict in record.values() for k, v in section_dict.items()} for record in records]
+    )
+    # Not every PDF carries every column, so only cast the ones present
+    return df.astype({col: dtype for col, dtype in SCHEMA.items() if col in df.columns}, copy=False)
 
-    df = pd.DataFrame(flat_records)
-    return df
+# Drops thousand separators and turns the decimal comma into a dot in one pass
+_NUMERIC_TRANS = str.maketrans({'.': None, ',': '.'})
 
 def process_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     cols_to_fix = ["Menge", "Bruttomasse", "Nettomasse", "Alkoholgehalt", "Positionsnummer", "Anzahl der Packstücke"]
     for col in cols_to_fix:
-        df[col] = (
-            df[col]
-            .astype(str)
-            .str.replace(".", "", regex=False)   # remove thousand separators
-            .str.replace(",", ".", regex=False)  # replace decimal comma
-            .astype(float)
-        )
-
-    df["Positionsnummer"] = df["Positionsnummer"].astype(int)
-    df["Anzahl der Packstücke"] = df["Anzahl der Packstücke"].astype(int)
+        # No astype(str) here — the columns are already string dtype via
+        # SCHEMA, and casting would render missing values as literal "<NA>";
+        # NA instead propagates through translate into to_numeric as NaN
+        df[col] = pd.to_numeric(df[col].str.translate(_NUMERIC_TRANS), errors='raise')
+
+    df["Positionsnummer"] = df["Positionsnummer"].astype('int32')
+    df["Anzahl der Packstücke"] = df["Anzahl der Packstücke"].astype('int32')
     df["Alkoholmenge"] = df["Menge"] * (df["Alkoholgehalt"] / 100)
     df["Alkoholmenge"] = df["Alkoholmenge"]
 
@@ -228,6 +275,46 @@ def process_dataframe(df: pd.DataFrame) -> pd.DataFrame:
     return df
 
 
+def run_pipeline(pdf_bytes: bytes) -> pd.DataFrame:
+    """
+    Full parse pipeline for one uploaded PDF. Takes the raw bytes so a single
+    pickle crosses the process boundary when submitted to EXECUTOR, keeping
+    Camelot's compute-heavy extraction off the Streamlit thread.
+    """
+    # One in-memory buffer of the upload feeds both Camelot passes; the page
+    # counter gets its own view because it runs concurrently with the first
+    # pass and BytesIO seek positions are not thread-safe
+    pdf_buf = BytesIO(pdf_bytes)
+
+    # Parse PDF with Camelot and count pages concurrently — Camelot spends its
+    # time in OpenCV/Ghostscript C code, so both overlap on a thread pool
+    with ThreadPoolExecutor(max_workers=2) as ex:
+        fut_tables = ex.submit(read_pdf_tables, pdf_buf)
+        fut_pages = ex.submit(check_number_of_pages, BytesIO(pdf_bytes))
+        number_of_camelot_tables, dfs = fut_tables.result()
+        number_of_pages = fut_pages.result()
+
+    # If number of pages greater than the number Camelot counted, apply Camelot stream logic
+    if number_of_pages > number_of_camelot_tables:
+        pdf_buf.seek(0)
+        dfs.append(read_camelot_missing(pdf_buf, number_of_pages))
+
+    # Flatten the table cells straight to text — no CSV quoting round-trip
+    raw_text = dataframes_to_text(dfs)
+
+    # Apply CSV modification in memory
+    raw_text = modify_lines(raw_text.splitlines(keepends=True))
+
+    # Structure to dictionary
+    articles = parse_articles(raw_text)
+    # Clean of unmapped values
+    articles = [{k: v for k, v in d.items() if k != "_UNMAPPED_VALUES"} for d in articles]
+    # Create dataframe from the data
+    clean_df = load_and_flatten(articles)
+    # Process dataframe
+    return process_dataframe(clean_df)
+
+
 def dataframe_to_excel_bytes(df: pd.DataFrame) -> bytes:
     """
     Convert a pandas DataFrame into an Excel file (bytes object).
@@ -236,67 +323,76 @@ def dataframe_to_excel_bytes(df: pd.DataFrame) -> bytes:
     cols_to_compute_total = ["Menge", "Bruttomasse", "Nettomasse", "Anzahl der Packstücke", "Alkoholmenge", "Alkoholgehalt"]
 
     output = BytesIO()
-    with pd.ExcelWriter(output, engine="xlsxwriter") as writer:
+    # constant_memory streams finished rows to temp storage instead of holding
+    # the whole workbook in RAM — rows must then be written top-to-bottom and
+    # row/column formats set before the data lands
+    with pd.ExcelWriter(output, engine="xlsxwriter", engine_kwargs={"options": {"constant_memory": True}}) as writer:
         workbook = writer.book
+        # Formats are shared across sheets, so create them once per workbook
         bold_format = workbook.add_format({"bold": True, "bg_color": "#D9E1F2", "num_format": "###0.000"})
         num_format = workbook.add_format({"num_format": "###0.000"})  # 3 decimals
+        int_format = workbook.add_format({"num_format": "###0"})
+        anzahl_total_format = workbook.add_format({"bold": True, "bg_color": "#D9E1F2", "num_format": "###0"})
+        # Same look as pandas' default to_excel header
+        header_format = workbook.add_format({"bold": True, "text_wrap": True, "valign": "top", "border": 1})
 
         def write_with_totals(dataframe: pd.DataFrame, sheet_name: str):
             """Helper to write dataframe + totals row with formatting"""
-            df_copy = dataframe.copy()
-
-            # Compute totals
-            totals = df_copy[cols_to_compute_total].sum().to_dict()
+            # Compute totals — the frame itself is never mutated, so no copy
+            totals = dataframe[cols_to_compute_total].sum().to_dict()
             totals_row = {col: totals.get(col, "") for col in cols_to_compute_total}
 
             # Force integer total for Anzahl der Packstücke
             if "Anzahl der Packstücke" in totals_row and totals_row["Anzahl der Packstücke"] != "":
                 totals_row["Anzahl der Packstücke"] = int(totals_row["Anzahl der Packstücke"])
 
-            totals_row.update({c: "" for c in df_copy.columns if c not in cols_to_compute_total})
+            totals_row.update({c: "" for c in dataframe.columns if c not in cols_to_compute_total})
             totals_row["Produktcode"] = "TOTAL"
             totals_row["Alkoholgehalt"] = ""
 
+            # Create the worksheet up front so all formatting can be applied
+            # before any row is written (required in constant_memory mode)
+            worksheet = workbook.add_worksheet(sheet_name)
+            total_row_idx = len(dataframe) + 1  # Excel row index is 1-based because of header
 
-            # Append totals row
-            df_copy = pd.concat([df_copy, pd.DataFrame([totals_row])], ignore_index=True)
-
-            # Write data
-            df_copy.to_excel(writer, index=False, sheet_name=sheet_name)
-
-            # Apply formatting
-            worksheet = writer.sheets[sheet_name]
-            total_row_idx = len(df_copy)  # Excel row index is 1-based because of header
-
-            # Anzahl der Packstücke in TOTAL format
-            anzahl_total_format = workbook.add_format({"bold": True, "bg_color": "#D9E1F2", "num_format": "###0"})
-            anzahl_col_idx = df_copy.columns.get_loc("Anzahl der Packstücke")  # zero-based index
-            # Get the value from df_copy
-            anzahl_total_value = df_copy.iloc[-1, anzahl_col_idx]
-
-            # Bold + highlight total row
-            worksheet.set_row(total_row_idx, None, bold_format)
+            # Column positions, computed once per sheet (zero-based indices)
+            col_idx_map = {col_name: idx for idx, col_name in enumerate(dataframe.columns)}
+            anzahl_col_idx = col_idx_map["Anzahl der Packstücke"]
 
             # Format numeric columns
-            for col_idx, col_name in enumerate(df_copy.columns):
+            for col_name, col_idx in col_idx_map.items():
                 if col_name in cols_to_compute_total:
                     if col_name == "Anzahl der Packstücke":
                         # Integer format for this column
-                        int_format = workbook.add_format({"num_format": "###0"})
                         worksheet.set_column(col_idx, col_idx, 15, int_format)
-                        df_copy[col_name, len(df_copy)] = df_copy[col_name].astype(int)
                     else:
                         worksheet.set_column(col_idx, col_idx, 15, num_format)
 
+            # Bold + highlight total row
+            worksheet.set_row(total_row_idx, None, bold_format)
+
+            # Write data row by row in strictly increasing row order —
+            # pandas' to_excel emits body cells column-major, and
+            # constant_memory silently drops writes to already-flushed rows
+            worksheet.write_row(0, 0, dataframe.columns, header_format)
+            for row_idx, row in enumerate(dataframe.itertuples(index=False), start=1):
+                worksheet.write_row(row_idx, 0, ["" if pd.isna(value) else value for value in row])
+
+            # Totals row goes directly below the data — no one-row DataFrame
+            # and concat needed
+            worksheet.write_row(total_row_idx, 0, [totals_row[c] for c in dataframe.columns])
             # Overwrite just that one cell with correct format
-            worksheet.write(total_row_idx, anzahl_col_idx, anzahl_total_value, anzahl_total_format)
+            worksheet.write(total_row_idx, anzahl_col_idx, totals_row["Anzahl der Packstücke"], anzahl_total_format)
 
         # First sheet = All records
         write_with_totals(df, "All")
 
-        # Separate sheets per Produktcode
-        for produktcode, group in df.groupby("Produktcode"):
-            sheet_name = str(produktcode)[:31]  # Excel sheet names max 31 chars
-            write_with_totals(group, sheet_name)
+        # Separate sheets per Produktcode — skipped for single-code EVDs,
+        # where the All sheet already holds exactly that group. Sorted so the
+        # sheet order is deterministic for identical input frames.
+        if df["Produktcode"].nunique() > 1:
+            for produktcode, group in df.groupby("Produktcode", sort=True):
+                sheet_name = str(produktcode)[:31]  # Excel sheet names max 31 chars
+                write_with_totals(group, sheet_name)
 
     return output.getvalue()
\ No newline at end of file